@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 import os
+import ijson
+import orjson
 import requests
 import time
-from datetime import datetime
-from supabase import create_client, Client
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from datetime import datetime, timezone
+from itertools import islice
 import logging
 
 # Set up logging
@@ -13,6 +17,27 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+BANNER = "\n".join([
+    "=" * 60,
+    "💱 Finnhub FOREX News Ingestion Service",
+    "📊 Fetches latest FOREX articles per run (up to BATCH_CAP)",
+    "📍 Stores in 'forex_news' table",
+    "=" * 60,
+])
+
+# Columns written per row
+TABLE_COLUMNS = ('id', 'category', 'datetime', 'headline', 'source', 'summary', 'url', 'ingested_at')
+
+REQUIRED_ENV_HELP = "\n".join([
+    "Required environment variables:",
+    "- FINNHUB_API_KEY",
+    "- SUPABASE_URL",
+    "- SUPABASE_KEY",
+    "Optional:",
+    "- BATCH_CAP (positive integer, default 1000)",
+    "- SUPABASE_DB_URL",
+])
+
 class FinnhubForexIngestion:
     def __init__(self):
         """Initialize the service with environment variables"""
@@ -20,38 +45,64 @@ class FinnhubForexIngestion:
         self.api_key = os.getenv('FINNHUB_API_KEY')
         supabase_url = os.getenv('SUPABASE_URL')
         supabase_key = os.getenv('SUPABASE_KEY')
+        self.db_url = os.getenv('SUPABASE_DB_URL')  # Optional, enables COPY for large batches
         
         # Validate environment variables
         if not all([self.api_key, supabase_url, supabase_key]):
             raise ValueError("Missing required environment variables")
         
-        # Initialize Supabase client
-        self.supabase = create_client(supabase_url, supabase_key)
+        # Reuse pooled HTTP connections for Finnhub and Supabase, retrying
+        # transient 429/5xx responses (honouring Retry-After) within the run.
+        # POST is only used for ingest_forex_news, which is idempotent, so it is retried too.
+        self.session = requests.Session()
+        retry = Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {'POST'},
+            respect_retry_after_header=True
+        )
+        self.session.mount('https://', HTTPAdapter(max_retries=retry))
         
         # Configuration
         self.base_url = "https://finnhub.io/api/v1/news"
+        self.finnhub_headers = {'X-Finnhub-Token': self.api_key}
         self.table_name = "forex_news"
+        rest_base = f"{supabase_url.rstrip('/')}/rest/v1"
+        self.max_id_url = f"{rest_base}/rpc/get_max_forex_id"
+        self.ingest_url = f"{rest_base}/rpc/ingest_forex_news"
+        self.rest_headers = {
+            'apikey': supabase_key,
+            'Authorization': f'Bearer {supabase_key}',
+            'Content-Type': 'application/json'
+        }
         self.min_id = 10  # Starting minId
+        batch_cap = os.getenv('BATCH_CAP', '1000')
+        if not batch_cap.isdigit() or int(batch_cap) < 1:
+            raise ValueError(f"BATCH_CAP must be a positive integer, got {batch_cap!r}")
+        self.batch_cap = int(batch_cap)  # Max articles per run
+        self.chunk_size = 500  # Rows per upsert request, well under PostgREST payload limits
+        self.copy_threshold = 500  # Batches larger than this use COPY when db_url is set
+        self.max_headline_len = 512  # Truncate long text fields at ingest
+        self.max_summary_len = 4096
         
     def get_last_news_id(self):
         """Get the highest news ID from database to use as next minId"""
         try:
-            result = self.supabase.table(self.table_name)\
-                .select('id')\
-                .order('id', desc=True)\
-                .limit(1)\
-                .execute()
-            
-            if result.data and len(result.data) > 0:
-                last_id = result.data[0]['id']
-                logger.info(f"Last ID in database: {last_id}")
-                return last_id
+            # get_max_forex_id is STABLE, so PostgREST accepts it as a GET
+            response = self.session.get(self.max_id_url, headers=self.rest_headers, timeout=30)
+            response.raise_for_status()
+            last_id = orjson.loads(response.content)
+            
+            if last_id is not None:
+                logger.info("Last ID in database: %s", last_id)
+                return int(last_id)
             else:
-                logger.info(f"No previous records, using default minId: {self.min_id}")
+                logger.info("No previous records, using default minId: %s", self.min_id)
                 return self.min_id
                 
         except Exception as e:
-            logger.warning(f"Could not get last ID, using default: {e}")
+            logger.warning("Could not get last ID, using default: %s", e)
             return self.min_id
     
     def fetch_forex_news(self):
@@ -63,48 +114,75 @@ class FinnhubForexIngestion:
             # API parameters - FOREX ONLY
             params = {
                 'category': 'forex',  # FOREX CATEGORY ONLY
-                'minId': min_id,
-                'token': self.api_key
+                'minId': min_id
             }
             
-            logger.info(f"Fetching FOREX news with minId: {min_id}")
-            response = requests.get(self.base_url, params=params, timeout=30)
-            response.raise_for_status()
-            
-            news_data = response.json()
-            logger.info(f"Fetched {len(news_data)} forex news articles")
+            logger.info("Fetching FOREX news with minId: %s", min_id)
+            with self.session.get(self.base_url, params=params, headers=self.finnhub_headers,
+                                  stream=True, timeout=30) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                
+                # Finnhub returns newest first, so stream-parse only up to the cap
+                # (plus one item to tell whether anything was left over)
+                latest = list(islice(ijson.items(response.raw, 'item', use_float=True), self.batch_cap + 1))
             
-            # Sort by datetime and take only latest 10
-            news_data.sort(key=lambda x: x.get('datetime', 0), reverse=True)
-            latest_10 = news_data[:10]
+            if len(latest) > self.batch_cap:
+                # Older articles past the cap are skipped for good: the next minId jumps past them
+                logger.warning("Exceeded BATCH_CAP (%d); older articles beyond the cap will not be ingested",
+                               self.batch_cap)
+                latest = latest[:self.batch_cap]
+            logger.info("Fetched %d forex news articles", len(latest))
             
-            return latest_10
+            return latest
             
         except requests.exceptions.RequestException as e:
-            logger.error(f"Error fetching news: {e}")
+            logger.error("Error fetching news: %s", e)
             return []
         except Exception as e:
-            logger.error(f"Unexpected error: {e}")
+            logger.error("Unexpected error: %s", e)
             return []
     
-    def check_duplicates(self, news_ids):
-        """Check which articles already exist in database"""
-        if not news_ids:
-            return set()
+    def upsert_news(self, rows):
+        """Insert rows via the ingest_forex_news RPC in chunks, returning how many were new"""
+        # The function does INSERT ... ON CONFLICT (id) DO NOTHING and returns the
+        # inserted count as a bare integer; payload serialized with orjson
+        inserted = 0
+        for start in range(0, len(rows), self.chunk_size):
+            response = self.session.post(
+                self.ingest_url,
+                headers=self.rest_headers,
+                data=orjson.dumps({'rows': rows[start:start + self.chunk_size]}),
+                timeout=30
+            )
+            response.raise_for_status()
+            inserted += orjson.loads(response.content) or 0
+        return inserted
+    
+    def copy_news(self, rows):
+        """Bulk load rows over a direct Postgres connection, returning how many were new"""
+        # Optional dependency, only needed when SUPABASE_DB_URL is set
+        import psycopg
         
-        try:
-            result = self.supabase.table(self.table_name)\
-                .select('id')\
-                .in_('id', news_ids)\
-                .execute()
-            
-            existing = {item['id'] for item in result.data} if result.data else set()
-            logger.info(f"Found {len(existing)} duplicates")
-            return existing
-            
-        except Exception as e:
-            logger.error(f"Error checking duplicates: {e}")
-            return set()
+        column_list = ', '.join(TABLE_COLUMNS)
+        
+        # COPY has no ON CONFLICT, so stage into a temp table and dedup on the way in.
+        # The stage holds only the loaded columns (no NOT NULL constraints copied), so
+        # any other table columns get their defaults on the final INSERT.
+        with psycopg.connect(self.db_url, connect_timeout=30) as conn, conn.cursor() as cur:
+            cur.execute(
+                f"CREATE TEMP TABLE forex_news_stage ON COMMIT DROP AS "
+                f"SELECT {column_list} FROM {self.table_name} WITH NO DATA"
+            )
+            with cur.copy(f"COPY forex_news_stage ({column_list}) FROM STDIN") as copy:
+                for row in rows:
+                    copy.write_row(tuple(row[c] for c in TABLE_COLUMNS))
+            cur.execute(
+                f"INSERT INTO {self.table_name} ({column_list}) "
+                f"SELECT {column_list} FROM forex_news_stage "
+                f"ON CONFLICT (id) DO NOTHING"
+            )
+            return cur.rowcount
     
     def store_news(self, articles):
         """Store news articles in Supabase forex_news table"""
@@ -113,43 +191,54 @@ class FinnhubForexIngestion:
             return True
         
         try:
-            # Check for duplicates
-            article_ids = [a['id'] for a in articles]
-            existing_ids = self.check_duplicates(article_ids)
-            
-            # Filter out duplicates
-            new_articles = []
-            for article in articles:
-                if article['id'] not in existing_ids:
-                    # Prepare article with only required fields
-                    formatted = {
-                        'id': article['id'],
-                        'category': article.get('category', 'forex'),
-                        'datetime': article.get('datetime'),
-                        'headline': article.get('headline', ''),
-                        'source': article.get('source', ''),
-                        'summary': article.get('summary', ''),
-                        'url': article.get('url', ''),
-                        'ingested_at': datetime.now().isoformat()
-                    }
-                    new_articles.append(formatted)
-            
-            if not new_articles:
+            # Prepare articles with only required fields (one timestamp per batch)
+            now_iso = datetime.now(timezone.utc).isoformat()
+            max_headline, max_summary = self.max_headline_len, self.max_summary_len
+            formatted = []
+            for a in articles:
+                # Skip articles with an unusable timestamp instead of failing the whole batch
+                ts = a.get('datetime')
+                try:
+                    dt = datetime.fromtimestamp(int(ts), tz=timezone.utc).isoformat() if ts is not None else None
+                except (TypeError, ValueError, OverflowError, OSError) as e:
+                    logger.warning("Skipping article %s with bad datetime %r: %s", a.get('id'), ts, e)
+                    continue
+                formatted.append({
+                    'id': a['id'],
+                    'category': a.get('category', 'forex'),
+                    'datetime': dt,
+                    'headline': (a.get('headline') or '')[:max_headline],
+                    'source': a.get('source', ''),
+                    'summary': (a.get('summary') or '')[:max_summary],
+                    'url': a.get('url', ''),
+                    'ingested_at': now_iso
+                })
+            
+            if not formatted:
+                logger.info("No valid articles to store")
+                return True
+            
+            # Large backfills go through COPY when a direct DB connection is configured
+            if self.db_url and len(formatted) > self.copy_threshold:
+                stored = self.copy_news(formatted)
+            else:
+                stored = self.upsert_news(formatted)
+            
+            if not stored:
                 logger.info("All articles already exist - no new articles to add")
                 return True
             
-            # Insert new articles into forex_news table
-            result = self.supabase.table(self.table_name).insert(new_articles).execute()
-            logger.info(f"✅ Stored {len(new_articles)} new FOREX articles")
+            logger.info("✅ Stored %d new FOREX articles", stored)
             
-            # Log first few headlines
-            for i, article in enumerate(new_articles[:3], 1):
-                logger.info(f"  {i}. {article['headline'][:60]}...")
+            # Log first few headlines (newest first)
+            if logger.isEnabledFor(logging.INFO):
+                for i, article in enumerate(formatted[:min(stored, 3)], 1):
+                    logger.info("  %d. %s...", i, article['headline'][:60])
             
             return True
             
         except Exception as e:
-            logger.error(f"Error storing articles: {e}")
+            logger.error("Error storing articles: %s", e)
             return False
     
     def run(self):
@@ -175,74 +264,27 @@ class FinnhubForexIngestion:
             return success
             
         except Exception as e:
-            logger.error(f"Fatal error: {e}")
+            logger.error("Fatal error: %s", e)
             return False
 
 
 def main():
-    """Main function - runs continuously every minute"""
-    logger.info("=" * 60)
-    logger.info("💱 Finnhub FOREX News Ingestion Service")
-    logger.info("📊 Fetches latest 10 FOREX articles every minute")
-    logger.info("📍 Stores in 'forex_news' table")
-    logger.info("=" * 60)
-    
-    # Check for run mode
-    run_mode = os.getenv('RUN_MODE', 'continuous').lower()
+    """Main function - runs one ingestion pass (scheduled externally every minute)"""
+    logger.info(BANNER)
     
     # Initialize service
     try:
         service = FinnhubForexIngestion()
     except ValueError as e:
-        logger.error(f"Configuration error: {e}")
-        logger.error("Required environment variables:")
-        logger.error("- FINNHUB_API_KEY")
-        logger.error("- SUPABASE_URL")
-        logger.error("- SUPABASE_KEY")
+        logger.error("Configuration error: %s", e)
+        logger.error(REQUIRED_ENV_HELP)
         exit(1)
     
-    # Run once mode
-    if run_mode == 'once':
-        logger.info("Running in ONCE mode")
-        success = service.run()
-        exit(0 if success else 1)
-    
-    # Continuous mode
-    logger.info("Running in CONTINUOUS mode")
-    failures = 0
-    max_failures = 5
-    
-    while True:
-        try:
-            start_time = datetime.now()
-            logger.info(f"\n{'=' * 50}")
-            logger.info(f"⏰ Run started at {start_time.strftime('%H:%M:%S')}")
-            
-            # Run ingestion
-            if service.run():
-                failures = 0
-            else:
-                failures += 1
-                if failures >= max_failures:
-                    logger.error(f"Too many failures ({max_failures}). Exiting...")
-                    exit(1)
-            
-            # Calculate sleep time
-            elapsed = (datetime.now() - start_time).total_seconds()
-            sleep_time = max(60 - elapsed, 1)
-            
-            logger.info(f"⏱️  Took {elapsed:.1f}s. Sleeping {sleep_time:.1f}s...")
-            time.sleep(sleep_time)
-            
-        except KeyboardInterrupt:
-            logger.info("\n⛔ Shutting down...")
-            break
-        except Exception as e:
-            logger.error(f"Unexpected error: {e}")
-            failures += 1
-            if failures >= max_failures:
-                exit(1)
-            time.sleep(60)
+    # Single run; scheduling and retries are left to systemd/Kubernetes (see deploy/)
+    t0 = time.monotonic()
+    success = service.run()
+    logger.info("⏱️  Took %.1fs", time.monotonic() - t0)
+    exit(0 if success else 1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,9 @@
+-- Highest stored forex news ID, used as the next Finnhub minId.
+-- Returns NULL on an empty table; the service then uses its default minId.
+CREATE OR REPLACE FUNCTION public.get_max_forex_id()
+RETURNS bigint
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT MAX(id) FROM public.forex_news
+$$;
@@ -0,0 +1,9 @@
+-- No extra index is needed for MAX(id) (used by get_max_forex_id): the
+-- ON CONFLICT (id) inserts already require a unique index on id (the primary
+-- key), and Postgres reads MAX(id) with a backward scan on it. Drop the
+-- redundant descending index if an earlier version of this migration made it.
+--
+-- Verify with:
+--   EXPLAIN (ANALYZE) SELECT MAX(id) FROM public.forex_news;
+-- which should show "Index Only Scan Backward" on the primary key index.
+DROP INDEX IF EXISTS public.forex_news_id_desc_idx;
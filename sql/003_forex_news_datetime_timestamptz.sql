@@ -0,0 +1,4 @@
+-- Store the article time as an 8-byte timestamptz instead of a Unix epoch
+-- number. From this migration on, the ingester sends ISO-8601 UTC strings.
+ALTER TABLE public.forex_news
+    ALTER COLUMN datetime TYPE timestamptz USING to_timestamp(datetime);
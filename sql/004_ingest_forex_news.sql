@@ -0,0 +1,17 @@
+-- Insert a JSON array of articles, skipping IDs that already exist, and
+-- return how many rows were actually inserted. Used by the ingester in
+-- place of a plain PostgREST upsert so dedup and counting happen in one
+-- statement, independent of PostgREST's Prefer header handling.
+CREATE OR REPLACE FUNCTION public.ingest_forex_news(rows jsonb)
+RETURNS integer
+LANGUAGE sql
+AS $$
+    WITH inserted AS (
+        INSERT INTO public.forex_news (id, category, datetime, headline, source, summary, url, ingested_at)
+        SELECT id, category, datetime, headline, source, summary, url, ingested_at
+        FROM jsonb_populate_recordset(NULL::public.forex_news, rows)
+        ON CONFLICT (id) DO NOTHING
+        RETURNING 1
+    )
+    SELECT count(*)::integer FROM inserted
+$$;